@@ -124,7 +124,7 @@ class CustomArguments:
             load_in_4bit=True,
             bnb_4bit_quant_type="nf4",
             bnb_4bit_use_double_quant=True,
-            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_compute_dtype=torch.bfloat16,
         ),
         metadata={
             "help": "Quant 4 bit config"
@@ -210,6 +210,12 @@ class CustomArguments:
             "help": "Number of hidden layers"
         },
     )
+    deterministic : Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Fully deterministic run (slower; for debugging/reproduction)"
+        },
+    )
     rag_response_threshold : Optional[int] = field(
         default=350,
         metadata={
@@ -90,10 +90,10 @@ def ensemble_by_softmax():
         model.to(DEVICE)
         model.eval()
         with torch.inference_mode():
-            for data in tqdm(test_dataset):
-                _id = data["id"]
-                messages = data["messages"]
-                len_choices = data["len_choices"]
+            for i in tqdm(range(len(test_dataset))):
+                _id = test_dataset.ids[i]
+                messages = test_dataset.messages[i]
+                len_choices = int(test_dataset.len_choices[i])
 
                 input = tokenizer.apply_chat_template(
                     messages,
@@ -1,11 +1,13 @@
+import hashlib
 import os
-os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+import shutil
 import sys
 import logging
 
+import jinja2
 import torch
 import wandb
-from datasets import Dataset
+from datasets import Dataset, load_from_disk
 import evaluate
 import numpy as np
 import pandas as pd
@@ -21,7 +23,8 @@ from retrieval_tasks import Reranker
 from retrieval_tasks import Semantic
 from retrieval_tasks import Syntactic
 from utils import (record_to_df, train_df_to_process_df, test_df_to_process_df, set_seed, optimize_model, apply_lora,
-                   train_df_to_process_df_with_rag, test_df_to_process_df_with_rag)
+                   remove_lora, train_df_to_process_df_with_rag, test_df_to_process_df_with_rag,
+                   pick_attn_implementation, filter_by_char_length, filter_by_token_length)
 
 SEED = 42
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
@@ -34,14 +37,13 @@ os.environ["WANDB_MODE"] = "disabled"
 logger = logging.getLogger(__name__)
 
 def main(run_name, debug=False):
-    set_seed(SEED)
-
     model_name = None
     adaptor = None
     parser = HfArgumentParser(
         (ModelArguments, DataTrainingArguments, TrainingArguments, CustomArguments)
     )
     model_args, data_args, train_args, custom_args = parser.parse_args_into_dataclasses()
+    set_seed(SEED, deterministic=custom_args.deterministic)
     plus_prompt, no_plus_prompt = custom_args.prompt_question_plus, custom_args.prompt_no_question_plus
     plus_prompt_rag, no_plus_prompt_rag = custom_args.prompt_question_plus_rag, custom_args.prompt_no_question_plus_rag
 
@@ -63,19 +65,24 @@ def main(run_name, debug=False):
     logging.info(f"model is from {model_args.model_name_or_path}")
     logging.info(f"data is from {data_args.dataset_name}")
 
-    # Load data
-    dataset = pd.read_csv(data_args.dataset_name)
+    # Load data (pyarrow 엔진: 멀티스레드 파싱으로 C 엔진보다 수 배 빠름)
+    dataset = pd.read_csv(data_args.dataset_name, engine="pyarrow")
     dataset = dataset.sample(10, random_state=SEED).reset_index(drop=True) if debug else dataset
     dataset.to_csv(os.path.join(parent_dir, 'data', f"sampled_dataset_{now}.csv")) if debug else None
 
     df = record_to_df(dataset)
 
+    attn_implementation = pick_attn_implementation()
+
     quant_config = None
-    if custom_args.quantization == 4:
-        quant_config = custom_args.quant_4_bit_config
+    # bitsandbytes 양자화는 학습 메모리 최적화 용도로, 추론에서는 오히려 2~5배 느림.
+    # 학습일 때만 적용하고 예측은 bf16 + LoRA 병합으로 로드
+    if train_args.do_train:
+        if custom_args.quantization == 4:
+            quant_config = custom_args.quant_4_bit_config
 
-    elif custom_args.quantization == 8:
-        quant_config = custom_args.quant_8_bit_config
+        elif custom_args.quantization == 8:
+            quant_config = custom_args.quant_8_bit_config
 
     # Load model
     if train_args.do_train:
@@ -86,7 +93,8 @@ def main(run_name, debug=False):
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
             config=config,
-            torch_dtype=torch.float32 if not isinstance(quant_config, BitsAndBytesConfig) else None,
+            torch_dtype=torch.bfloat16 if not isinstance(quant_config, BitsAndBytesConfig) else None,
+            attn_implementation=attn_implementation,
             trust_remote_code=True,
             quantization_config=quant_config if isinstance(quant_config, BitsAndBytesConfig) else None,
             device_map="auto",
@@ -101,10 +109,13 @@ def main(run_name, debug=False):
         model_name = os.path.join(model_args.model_name_or_path, latest_ckpt)
         model = AutoPeftModelForCausalLM.from_pretrained(
             model_name,
-            torch_dtype=torch.float32 if not isinstance(quant_config, BitsAndBytesConfig) else None,
+            torch_dtype=torch.bfloat16 if not isinstance(quant_config, BitsAndBytesConfig) else None,
+            attn_implementation=attn_implementation,
             trust_remote_code=True,
             quantization_config=quant_config if isinstance(quant_config, BitsAndBytesConfig) else None,
         )
+        # LoRA 분기 matmul을 단일 dense matmul로 병합해 추론 처리량 복원
+        model = remove_lora(model)
 
     if not train_args.do_train and custom_args.do_rag:
         latest_ckpt = sorted(os.listdir(model_args.model_name_or_path))[-1]
@@ -112,7 +123,8 @@ def main(run_name, debug=False):
         model_name = custom_args.peft_base
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
-            torch_dtype="auto" if not isinstance(quant_config, BitsAndBytesConfig) else None,
+            torch_dtype=torch.bfloat16 if not isinstance(quant_config, BitsAndBytesConfig) else None,
+            attn_implementation=attn_implementation,
             trust_remote_code=True,
             quantization_config=quant_config if isinstance(quant_config, BitsAndBytesConfig) else None,
         )
@@ -124,9 +136,15 @@ def main(run_name, debug=False):
 
     custom_args.peft_base_chat_template = tokenizer.chat_template
     tokenizer.chat_template = custom_args.chat_template
+    # pad 설정은 토큰화 map 이전에 고정 — map 이후에 바꾸면 tokenize의 fingerprint가
+    # 달라져 디스크 캐시가 무효화되고 매 실행마다 재토큰화됨
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = 'right'
     peft_config = custom_args.peft_config
     if not train_args.do_train and custom_args.do_rag:
-        model = apply_lora(model, adaptor)
+        # 어댑터를 적용한 뒤 곧바로 병합해 두 갈래 LoRA matmul 비용을 제거
+        model = remove_lora(apply_lora(model, adaptor))
 
     if custom_args.do_rag:
         step_1_retriever = Syntactic(
@@ -184,16 +202,13 @@ def main(run_name, debug=False):
     if custom_args.do_rag:
         processed_dataset = train_df_to_process_df_with_rag(dataset, plus_prompt_rag, no_plus_prompt_rag, retriever, model, tokenizer, adaptor, custom_args, data_args)
 
+    # Jinja 템플릿을 한 번만 컴파일해 호출마다 템플릿을 다시 파싱하지 않도록 함
+    # (trim_blocks/lstrip_blocks는 HF apply_chat_template과 동일한 설정)
+    chat_template_env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+    compiled_chat_template = chat_template_env.from_string(tokenizer.chat_template)
+
     def formatting_prompts_func(example):
-        output_texts = []
-        for i in range(len(example["messages"])):
-            output_texts.append(
-                tokenizer.apply_chat_template(
-                    example["messages"][i],
-                    tokenize=False,
-                )
-            )
-        return output_texts
+        return [compiled_chat_template.render(messages=messages) for messages in example["messages"]]
 
     def tokenize(element):
         outputs = tokenizer(
@@ -201,22 +216,32 @@ def main(run_name, debug=False):
             truncation=False,
             padding=False,
             return_overflowing_tokens=False,
-            return_length=False,
+            return_length=True,
         )
         return {
             "input_ids": outputs["input_ids"],
             "attention_mask": outputs["attention_mask"],
+            "length": outputs["length"],
         }
 
     mex_seq_len = data_args.max_seq_length
 
+    # 정답 토큰(1~5)의 id는 고정이므로 시작 시 한 번만 계산해 전 구간에서 재사용
+    # (.vocab은 BPE 병합 전 내부 vocab을 반환할 수 있으므로 convert_tokens_to_ids 사용)
+    digit_token_ids = torch.tensor(
+        tokenizer.convert_tokens_to_ids([str(i) for i in range(1, 6)]),
+        dtype=torch.long,
+        device=DEVICE,
+    )
+    # 정답 토큰 id -> 0~4 인덱스 LUT (레이블을 문자열 디코딩 없이 바로 변환)
+    digit_index_lut = np.full(len(tokenizer), -1, dtype=np.int64)
+    digit_index_lut[digit_token_ids.cpu().numpy()] = np.arange(5)
+
     # 모델의 logits 를 조정하여 정답 토큰 부분만 출력하도록 설정
     def preprocess_logits_for_metrics(logits, labels):
         logits = logits if not isinstance(logits, tuple) else logits[0]
-        logit_idx = [tokenizer.vocab["1"], tokenizer.vocab["2"], tokenizer.vocab["3"], tokenizer.vocab["4"],
-                     tokenizer.vocab["5"]]
-        logits = logits[:, -2, logit_idx]  # -2: answer token, -1: eos token
-        return logits
+        # -2: answer token, -1: eos token
+        return logits[:, -2].index_select(-1, digit_token_ids.to(logits.device))
 
     # metric 로드
     acc_metric = evaluate.load("accuracy")
@@ -224,40 +249,77 @@ def main(run_name, debug=False):
     def compute_metrics(evaluation_result):
         logits, labels = evaluation_result
 
-        # 토큰화된 레이블 디코딩
+        # response_template 뒤 첫 레이블 토큰은 개행이므로, 행마다 첫 '숫자' 토큰의
+        # 위치를 찾아 batch_decode 없이 토큰 id로 바로 변환
         labels = np.where(labels != -100, labels, tokenizer.pad_token_id)
-        labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
-        labels = list(map(lambda x: x.split("<end_of_turn>")[0].strip(), labels))
-        # 실제 지문은 1에서 시작, 인덱스는 0부터 시작하므로
-        labels = list(map(lambda x: int(x) - 1, labels))
-
-        # 소프트맥스 함수를 사용하여 로그트 변환
-        probs = torch.nn.functional.softmax(torch.FloatTensor(logits), dim=-1)
-        predictions = np.argmax(probs, axis=-1)
+        digit_pos = (digit_index_lut[labels] >= 0).argmax(axis=1)
+        # 실제 지문은 1에서 시작, 인덱스는 0부터 시작하므로 LUT가 1~5 토큰을 0~4로 매핑
+        refs = digit_index_lut[labels[np.arange(len(labels)), digit_pos]]
+        if (refs < 0).any():
+            # 숫자 토큰이 없는 행이 있으면 조용히 틀리지 않도록 디코딩 경로로 폴백
+            decoded = tokenizer.batch_decode(labels, skip_special_tokens=True)
+            refs = np.array([int(x.split("<end_of_turn>")[0].strip()) - 1 for x in decoded])
+        labels = refs
+
+        # softmax는 단조 함수이므로 logits의 argmax와 결과가 동일함
+        predictions = np.argmax(logits, axis=-1)
 
         # 정확도 계산
         acc = acc_metric.compute(predictions=predictions, references=labels)
+
+        # 확신도 지표: softmax 확률 대신 단조 동치인 logit margin(1위-2위)만 기록
+        top2 = np.partition(logits, -2, axis=-1)[:, -2:]
+        acc["mean_margin"] = float(np.mean(top2[:, 1] - top2[:, 0]))
         return acc
 
     try:
         if train_args.do_train:
-            dataset = Dataset.from_pandas(df)
-            processed_dataset = train_df_to_process_df(dataset, plus_prompt, no_plus_prompt)
-
-            tokenizer.chat_template = custom_args.chat_template
-            # 데이터 토큰화
-            tokenized_dataset = processed_dataset.map(
-                tokenize,
-                remove_columns=list(processed_dataset.features),
-                batched=True,
-                num_proc=4,
-                load_from_cache_file=True,
-                desc="Tokenizing",
-            )
+            # (모델, 길이 제한, 분할 비율, 원본 데이터, 템플릿/프롬프트) 조합이 같으면
+            # 전처리 전체를 건너뛰고 저장해 둔 train/eval 분할을 mmap으로 바로 로드
+            cache_key = hashlib.md5(
+                f"{model_args.model_name_or_path}_{mex_seq_len}_{model_args.train_test_split}_"
+                f"{data_args.dataset_name}_{os.path.getmtime(data_args.dataset_name)}_{debug}_"
+                f"{custom_args.chat_template}_{plus_prompt}_{no_plus_prompt}".encode()
+            ).hexdigest()
+            cache_dir = os.path.join(parent_dir, '.cache', cache_key)
+
+            if os.path.isdir(cache_dir):
+                tokenized_dataset = load_from_disk(cache_dir)
+            else:
+                dataset = Dataset.from_pandas(df)
+                processed_dataset = train_df_to_process_df(dataset, plus_prompt, no_plus_prompt)
+
+                tokenizer.chat_template = custom_args.chat_template
+
+                # 어차피 길이 필터에서 버려질 데이터는 토큰화 전에 문자 수 상한으로 미리 제외
+                # (한국어 혼합 텍스트 기준 토큰당 문자 수 상한 K=4는 경험적으로 안전한 값)
+                processed_dataset = processed_dataset.filter(
+                    filter_by_char_length, fn_kwargs={"char_limit": mex_seq_len * 4}
+                )
+
+                # 데이터 토큰화
+                tokenized_dataset = processed_dataset.map(
+                    tokenize,
+                    remove_columns=list(processed_dataset.features),
+                    batched=True,
+                    num_proc=min(os.cpu_count(), 16) if tokenizer.is_fast else 4,
+                    load_from_cache_file=True,
+                    desc="Tokenizing",
+                )
+
+                # vram memory 제약으로 인해 인풋 데이터의 길이가 1024 초과인 데이터는 제외하였습니다. 1024보다 길이가 더 긴 데이터를 포함하면 더 높은 점수를 달성할 수 있을 것 같습니다.
+                tokenized_dataset = tokenized_dataset.filter(
+                    filter_by_token_length, fn_kwargs={"max_len": mex_seq_len}
+                )
+                tokenized_dataset = tokenized_dataset.train_test_split(test_size=model_args.train_test_split, seed=SEED)
 
-            # vram memory 제약으로 인해 인풋 데이터의 길이가 1024 초과인 데이터는 제외하였습니다. 1024보다 길이가 더 긴 데이터를 포함하면 더 높은 점수를 달성할 수 있을 것 같습니다.
-            tokenized_dataset = tokenized_dataset.filter(lambda x: len(x["input_ids"]) <= data_args.max_seq_length)
-            tokenized_dataset = tokenized_dataset.train_test_split(test_size=model_args.train_test_split, seed=SEED)
+                # 저장 도중 중단된 부분 디렉토리가 캐시 히트로 잡히지 않도록
+                # 임시 경로에 쓴 뒤 성공 시에만 rename
+                tmp_cache_dir = cache_dir + ".tmp"
+                if os.path.isdir(tmp_cache_dir):
+                    shutil.rmtree(tmp_cache_dir)
+                tokenized_dataset.save_to_disk(tmp_cache_dir)
+                os.rename(tmp_cache_dir, cache_dir)
 
             train_dataset = tokenized_dataset['train']
             eval_dataset = tokenized_dataset['test']
@@ -267,19 +329,17 @@ def main(run_name, debug=False):
                 tokenizer=tokenizer,
             )
 
-            # 모델 설정, pad token 설정
-            tokenizer.pad_token = tokenizer.eos_token
-            tokenizer.pad_token_id = tokenizer.eos_token_id
-            tokenizer.padding_side = 'right'
-
             sft_config = SFTConfig(
                 output_dir=train_args.output_dir,
                 do_train=True,
                 do_eval=True,
                 lr_scheduler_type="cosine",
                 max_seq_length=data_args.max_seq_length,
-                per_device_train_batch_size=1,
+                # packing=True는 DataCollatorForCompletionOnlyLM의 시퀀스별 마스킹과
+                # 호환되지 않아 사용하지 않고, 대신 실배치를 키움
+                per_device_train_batch_size=4,
                 per_device_eval_batch_size=1,
+                gradient_accumulation_steps=2,
                 num_train_epochs=1,
                 learning_rate=2e-5,
                 weight_decay=0.01,
@@ -289,7 +349,12 @@ def main(run_name, debug=False):
                 save_total_limit=1,
                 save_only_model=True,
                 # report_to="wandb",
+                bf16=True,
+                tf32=True,
+                dataloader_num_workers=4,
+                dataloader_pin_memory=True,
                 gradient_checkpointing=custom_args.gc_flag,  # 그래디언트 체크포인팅 활성화
+                gradient_checkpointing_kwargs={"use_reentrant": False},
             )
 
             trainer = SFTTrainer(
@@ -306,48 +371,67 @@ def main(run_name, debug=False):
             trainer.train()
 
         if train_args.do_predict:
-            test_df = pd.read_csv(data_args.test_dataset_name)
+            test_df = pd.read_csv(data_args.test_dataset_name, engine="pyarrow")
             test_df = record_to_df(test_df)
             if not custom_args.do_rag:
                 test_dataset = test_df_to_process_df(test_df, plus_prompt, no_plus_prompt)
             if custom_args.do_rag:
                 test_dataset = test_df_to_process_df_with_rag(test_df, plus_prompt_rag, no_plus_prompt_rag, retriever, model, tokenizer, adaptor, custom_args, data_args)
             
-            infer_results = []
             pred_choices_map = {0: "1", 1: "2", 2: "3", 3: "4", 4: "5"}
+            eval_batch_size = train_args.per_device_eval_batch_size
+            # list-of-dict append 대신 결과 배열을 미리 할당하고 인덱스로 기록
+            answers = np.empty(len(test_dataset), dtype='<U1')
 
-            model.to(DEVICE)
-            model.eval()
-            with torch.inference_mode():
-                for data in tqdm(test_dataset):
-                    _id = data["id"]
-                    messages = data["messages"]
-                    len_choices = data["len_choices"]
+            # 프롬프트를 한 번에 템플릿 적용 후 배치 토큰화 (샘플당 개별 forward 제거)
+            prompts = [
+                tokenizer.apply_chat_template(
+                    messages,
+                    tokenize=False,
+                    add_generation_prompt=True,
+                )
+                for messages in test_dataset.messages
+            ]
+            ids = test_dataset.ids
+            len_choices_list = test_dataset.len_choices
 
-                    input = tokenizer.apply_chat_template(
-                            messages,
-                            tokenize=True,
-                            add_generation_prompt=True,
-                            return_tensors="pt",
-                        ).to(DEVICE)
+            # 배치 추론 시 정답 토큰이 항상 마지막 위치에 오도록 left padding 사용
+            tokenizer.padding_side = 'left'
 
-                    outputs = model(input)
+            model.to(DEVICE)
+            model.eval()
+            # 작은 커널 런치들을 CUDA graph로 묶어 배치당 런치 오버헤드 제거
+            model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
 
-                    logits = outputs.logits[:, -1].flatten().cpu()
+            with torch.inference_mode():
+                for start in tqdm(range(0, len(prompts), eval_batch_size)):
+                    batch_prompts = prompts[start:start + eval_batch_size]
+                    # 64 배수로 패딩해 입력 shape 종류를 줄여 재컴파일을 최소화
+                    enc = tokenizer(
+                        batch_prompts, padding=True, pad_to_multiple_of=64, return_tensors="pt"
+                    )
+                    # pinned memory + non_blocking 복사로 H2D 전송을 GPU 연산과 겹침
+                    if torch.cuda.is_available():
+                        enc = {k: v.pin_memory().to(DEVICE, non_blocking=True) for k, v in enc.items()}
+                    else:
+                        enc = enc.to(DEVICE)
 
-                    target_logit_list = [logits[tokenizer.vocab[str(i + 1)]] for i in range(len_choices)]
+                    outputs = model(**enc)
 
-                    probs = (
-                        torch.nn.functional.softmax(torch.tensor(target_logit_list, dtype=torch.float32),
-                                                    dim=-1).detach().cpu().numpy()
-                    )
+                    # [B, 5] : 마지막 토큰 위치에서 1~5 토큰의 logit만 추출
+                    batch_logits = outputs.logits[:, -1, digit_token_ids]
 
-                    predict_value = pred_choices_map[np.argmax(probs, axis=-1)]
-                    infer_results.append({"id": _id, "answer": predict_value})
+                    for j in range(len(batch_prompts)):
+                        len_choices = int(len_choices_list[start + j])
+                        pred_idx = int(batch_logits[j, :len_choices].argmax())
+                        answers[start + j] = pred_choices_map[pred_idx]
 
             os.makedirs(train_args.output_dir, exist_ok=True)
-            pd.DataFrame(infer_results).to_csv(os.path.join(train_args.output_dir, 'predictions.csv'), index=False)
-            print(pd.DataFrame(infer_results))
+            infer_results = pd.DataFrame({"id": ids, "answer": answers})
+            infer_results.to_csv(os.path.join(train_args.output_dir, 'predictions.csv'), index=False)
+            # 큰 DataFrame의 repr 포매팅은 수 초가 걸릴 수 있어 디버그에서만 출력
+            if debug:
+                print(infer_results)
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -15,17 +15,23 @@ def len_of_tokens(tokenizer, context):
     tokens = tokenizer.tokenize(context)
     return len(tokens)
 
+# retrieve()가 샘플마다 호출되므로 템플릿 길이는 한 번만 계산하고 재사용
+_template_token_len_cache = {}
+
 def len_of_chat_template(tokenizer, custom_args: CustomArguments):
-    message = [
-                {"role": "system", "content": custom_args.rag_system_prompt},
-                {"role": "user", "content": ""},
-                {"role": "assistant", "content": ""}
-            ]
-    template = tokenizer.apply_chat_template(
-                    message,
-                    tokenize=False,
-                )
-    return len_of_tokens(tokenizer, template)
+    cache_key = (id(tokenizer), tokenizer.chat_template, custom_args.rag_system_prompt)
+    if cache_key not in _template_token_len_cache:
+        message = [
+                    {"role": "system", "content": custom_args.rag_system_prompt},
+                    {"role": "user", "content": ""},
+                    {"role": "assistant", "content": ""}
+                ]
+        template = tokenizer.apply_chat_template(
+                        message,
+                        tokenize=False,
+                    )
+        _template_token_len_cache[cache_key] = len_of_tokens(tokenizer, template)
+    return _template_token_len_cache[cache_key]
 
 def truncation(tokenizer, contexts: str, max_response_tokens):
     token_ids = tokenizer.encode(
@@ -1,5 +1,7 @@
+import os
 import random
 from ast import literal_eval
+from dataclasses import dataclass
 
 import pandas as pd
 import numpy as np
@@ -12,15 +14,32 @@ from peft import PeftModel
 from arguments import DataTrainingArguments, CustomArguments
 from retrieval_tasks.retrieve import retrieve
 
-def set_seed(seed: int = 42):
+def set_seed(seed: int = 42, deterministic: bool = False):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
-    torch.use_deterministic_algorithms(True)
+    if deterministic:
+        # 디버그/재현용 경로: 가장 빠른 cuBLAS/cuDNN 알고리즘이 비활성화되어 느려짐
+        os.environ["CUBLAS_WORKSPACE_CONFIG"] = ":4096:8"
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+        torch.use_deterministic_algorithms(True)
+    else:
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+        # Ampere+에서 TF32 tensor core 경로 활성화
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+def pick_attn_implementation():
+    # flash-attn이 설치되어 있으면 FlashAttention-2, 없으면 PyTorch SDPA로 폴백
+    try:
+        import flash_attn  # noqa: F401
+        return "flash_attention_2"
+    except ImportError:
+        return "sdpa"
 
 def apply_lora(model, adaptor_path):
     lora_model = PeftModel.from_pretrained(model, adaptor_path)
@@ -31,95 +50,117 @@ def remove_lora(model):
     return vanilla_model
 
 def record_to_df(dataset : pd.DataFrame) -> pd.DataFrame:
-    records = []
-    for _, row in dataset.iterrows():
-        problems = literal_eval(row['problems'])
-        record = {
-            'id': row['id'],
-            'paragraph': row['paragraph'],
-            'question': problems['question'],
-            'choices': problems['choices'],
-            'answer': problems.get('answer', None),
-            "question_plus": problems.get('question_plus', None),
-        }
-        # Include 'question_plus' if it exists
-        if 'question_plus' in problems:
-            record['question_plus'] = problems['question_plus']
-        records.append(record)
-
-    return pd.DataFrame(records)
-
-def train_df_to_process_df(dataset : pd.DataFrame, q_plus, no_q_plus) -> Dataset:
-    processed_dataset = []
-    for i in range(len(dataset)):
-        choices_string = "\n".join([f"{idx + 1} - {choice}" for idx, choice in enumerate(dataset[i]["choices"])])
-
-        # <보기>가 있을 때
-        if dataset[i]["question_plus"]:
-            user_message = q_plus.format(
-                paragraph=dataset[i]["paragraph"],
-                question=dataset[i]["question"],
-                question_plus=dataset[i]["question_plus"],
-                choices=choices_string,
-            )
-        # <보기>가 없을 때
-        else:
-            user_message = no_q_plus.format(
-                paragraph=dataset[i]["paragraph"],
-                question=dataset[i]["question"],
-                choices=choices_string,
-            )
-
-        # chat message 형식으로 변환
-        processed_dataset.append(
-            {
-                "id": dataset[i]["id"],
-                "messages": [
-                    {"role": "system", "content": "지문을 읽고 질문의 답을 구하세요."},
-                    {"role": "user", "content": user_message},
-                    {"role": "assistant", "content": f"{dataset[i]['answer']}"}
-                ],
-                "label": dataset[i]["answer"],
-            }
-        )
-
-    return Dataset.from_pandas(pd.DataFrame(processed_dataset))
-
-def test_df_to_process_df(dataset : pd.DataFrame, q_plus, no_q_plus) -> list:
-    test_dataset = []
-    for i, row in dataset.iterrows():
-        choices_string = "\n".join([f"{idx + 1} - {choice}" for idx, choice in enumerate(row["choices"])])
-        len_choices = len(row["choices"])
-
-        # <보기>가 있을 때
-        if row["question_plus"]:
-            user_message = q_plus.format(
-                paragraph=row["paragraph"],
-                question=row["question"],
-                question_plus=row["question_plus"],
-                choices=choices_string,
-            )
-        # <보기>가 없을 때
-        else:
-            user_message = no_q_plus.format(
-                paragraph=row["paragraph"],
-                question=row["question"],
-                choices=choices_string,
-            )
-
-        test_dataset.append(
-            {
-                "id": row["id"],
-                "messages": [
-                    {"role": "system", "content": "지문을 읽고 질문의 답을 구하세요."},
-                    {"role": "user", "content": user_message},
-                ],
-                "label": row["answer"],
-                "len_choices": len_choices,
-            }
+    # 행 단위 iterrows 대신 컬럼 단위로 한 번에 파싱 (pandas C-level 연산 사용)
+    problems = dataset['problems'].map(literal_eval)
+    problems_df = pd.json_normalize(problems)
+    # 'answer'/'question_plus'가 없는 데이터셋에서도 컬럼이 항상 존재하도록 보장
+    problems_df = problems_df.reindex(columns=['question', 'choices', 'answer', 'question_plus'])
+    problems_df = problems_df.where(problems_df.notna(), None)
+
+    return pd.concat(
+        [dataset[['id', 'paragraph']].reset_index(drop=True), problems_df.reset_index(drop=True)],
+        axis=1,
+    )
+
+def _build_user_message(q_plus, no_q_plus, paragraph, question, question_plus, choices):
+    choices_string = "\n".join([f"{idx + 1} - {choice}" for idx, choice in enumerate(choices)])
+
+    # <보기>가 있을 때
+    if question_plus:
+        return q_plus.format(
+            paragraph=paragraph,
+            question=question,
+            question_plus=question_plus,
+            choices=choices_string,
         )
-
-    return test_dataset
+    # <보기>가 없을 때
+    return no_q_plus.format(
+        paragraph=paragraph,
+        question=question,
+        choices=choices_string,
+    )
+
+def train_df_to_process_df(dataset : Dataset, q_plus, no_q_plus) -> Dataset:
+    # batched map + num_proc으로 행별 문자열 포매팅을 코어 수만큼 병렬화
+    def build_message(batch):
+        messages, labels = [], []
+        for paragraph, question, question_plus, choices, answer in zip(
+            batch["paragraph"], batch["question"], batch["question_plus"], batch["choices"], batch["answer"]
+        ):
+            user_message = _build_user_message(q_plus, no_q_plus, paragraph, question, question_plus, choices)
+
+            # chat message 형식으로 변환
+            messages.append([
+                {"role": "system", "content": "지문을 읽고 질문의 답을 구하세요."},
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": f"{answer}"}
+            ])
+            labels.append(answer)
+
+        return {"id": batch["id"], "messages": messages, "label": labels}
+
+    return dataset.map(
+        build_message,
+        batched=True,
+        num_proc=os.cpu_count(),
+        remove_columns=dataset.column_names,
+        desc="Formatting prompts",
+    )
+
+@dataclass
+class ProcessedTestData:
+    """예측 루프용 Struct-of-Arrays 레이아웃.
+
+    샘플별 dict 조회 대신 연속 배열 인덱싱으로 접근하며,
+    슬라이싱만으로 배치 추론 입력을 만들 수 있다.
+    """
+    ids: np.ndarray
+    messages: list
+    labels: np.ndarray
+    len_choices: np.ndarray
+
+    def __len__(self):
+        return len(self.messages)
+
+def test_df_to_process_df(dataset : pd.DataFrame, q_plus, no_q_plus) -> ProcessedTestData:
+    def build_message(batch):
+        messages, len_choices = [], []
+        for paragraph, question, question_plus, choices in zip(
+            batch["paragraph"], batch["question"], batch["question_plus"], batch["choices"]
+        ):
+            user_message = _build_user_message(q_plus, no_q_plus, paragraph, question, question_plus, choices)
+
+            messages.append([
+                {"role": "system", "content": "지문을 읽고 질문의 답을 구하세요."},
+                {"role": "user", "content": user_message},
+            ])
+            len_choices.append(len(choices))
+
+        return {"id": batch["id"], "messages": messages, "label": batch["answer"], "len_choices": len_choices}
+
+    hf_dataset = Dataset.from_pandas(dataset)
+    processed = hf_dataset.map(
+        build_message,
+        batched=True,
+        num_proc=os.cpu_count(),
+        remove_columns=hf_dataset.column_names,
+        desc="Formatting prompts",
+    )
+
+    return ProcessedTestData(
+        ids=np.array(processed["id"], dtype=object),
+        messages=processed["messages"],
+        labels=np.array(processed["label"], dtype=object),
+        len_choices=np.array(processed["len_choices"], dtype=np.int32),
+    )
+
+# .filter에 lambda 대신 top-level 함수 + fn_kwargs를 쓰면 클로저가 fingerprint에
+# 잡히지 않아 max_seq_length가 같은 한 HF 캐시가 그대로 재사용됨
+def filter_by_char_length(example, char_limit):
+    return sum(len(m["content"]) for m in example["messages"]) <= char_limit
+
+def filter_by_token_length(example, max_len):
+    return example["length"] <= max_len
 
 def optimize_model(config : transformers.AutoConfig, data_args, custom_args):
     config.use_cache = False
@@ -215,10 +256,10 @@ def test_df_to_process_df_with_rag(
         model, 
         tokenizer, 
         adaptor_path, 
-        custom_args: CustomArguments, 
+        custom_args: CustomArguments,
         data_args: DataTrainingArguments
-    ):
-    test_dataset = []
+    ) -> ProcessedTestData:
+    ids, messages, labels, len_choices_list = [], [], [], []
 
     def rag_process(retriever, model, tokenizer, message, max_seq_length, custom_args: CustomArguments):
         # model = remove_lora(model)
@@ -273,17 +314,18 @@ def test_df_to_process_df_with_rag(
                     choices=choices_string,
                 )
 
-        test_dataset.append(
-            {
-                "id": row["id"],
-                "messages": [
-                    {"role": "system", "content": custom_args.rag_system_prompt},
-                    {"role": "user", "content": user_message},
-                ],
-                "label": row["answer"],
-                "len_choices": len_choices,
-            }
-        )
-
-    return test_dataset
+        ids.append(row["id"])
+        messages.append([
+            {"role": "system", "content": custom_args.rag_system_prompt},
+            {"role": "user", "content": user_message},
+        ])
+        labels.append(row["answer"])
+        len_choices_list.append(len_choices)
+
+    return ProcessedTestData(
+        ids=np.array(ids, dtype=object),
+        messages=messages,
+        labels=np.array(labels, dtype=object),
+        len_choices=np.array(len_choices_list, dtype=np.int32),
+    )
 